@@ -1,12 +1,11 @@
 # File: ai-pdf2docx.py
 import argparse
-import os
 import sys
 
 # Assuming phase1_pdf_to_json.py and phase2_json_to_docx.py are in the same directory
 # or accessible via PYTHONPATH
 try:
-    from phase1_pdf_to_json import run_pdf_to_json_conversion
+    from phase1_pdf_to_json import non_negative_int, run_pdf_to_json_conversion
     from phase2_json_to_docx import run_json_to_docx_conversion
 except ImportError as e:
     print(f"Error importing phase modules: {e}")
@@ -24,8 +23,14 @@ def main():
     parser_pdf2json.add_argument("--project_id", required=True, help="Google Cloud Project ID.")
     parser_pdf2json.add_argument("--location", default="us-central1", help="Google Cloud location (default: us-central1).")
     parser_pdf2json.add_argument("--model", default="gemini-1.5-pro-001", help="Name of the Gemini model (default: gemini-1.5-pro-001).")
-    parser_pdf2json.add_argument("--delay", type=int, default=0, help="Delay in seconds between API calls (default: 0).")
+    parser_pdf2json.add_argument("--delay", type=int, default=0, help="Optional minimum delay in seconds between API calls (default: 0).")
+    parser_pdf2json.add_argument("--max_retries", type=non_negative_int, default=5, help="Retries for rate-limited or transient API errors, with exponential backoff (default: 5).")
+    parser_pdf2json.add_argument("--workers", type=int, default=8, help="Number of PDFs to send to Gemini concurrently (default: 8).")
     parser_pdf2json.add_argument("--overwrite", action="store_true", help="Overwrite existing JSON files.")
+    parser_pdf2json.add_argument("--cache_dir", help="Directory for cached Gemini responses (default: ~/.cache/ai-pdf2docx, or %%LOCALAPPDATA%%\\ai-pdf2docx on Windows).")
+    parser_pdf2json.add_argument("--no_cache", action="store_true", help="Do not read or write cached Gemini responses.")
+    parser_pdf2json.add_argument("--refresh_cache", action="store_true", help="Query Gemini even if a cached response exists, and update the cache.")
+    parser_pdf2json.add_argument("--gcs_staging_bucket", help="GCS bucket to stage PDFs of 1 MiB or more in, instead of inlining them in the request.")
     parser_pdf2json.set_defaults(func=run_pdf_to_json_conversion)
 
     # --- json2docx Subcommand ---
@@ -33,20 +38,13 @@ def main():
     parser_json2docx.add_argument("input_json_directory", help="Path to the directory containing JSON files.")
     parser_json2docx.add_argument("output_docx_directory", help="Path to the directory where DOCX files will be saved.")
     parser_json2docx.add_argument("--overwrite", action="store_true", help="Overwrite existing DOCX files.")
+    parser_json2docx.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs).")
+    parser_json2docx.add_argument("--fast_save", action="store_true", help="Write DOCX files without zip compression: faster, but much larger files.")
     parser_json2docx.set_defaults(func=run_json_to_docx_conversion)
 
     args = parser.parse_args()
     
-    # Ensure output directories exist or create them if they are specific to a run
-    if args.command == "pdf2json":
-        if not os.path.exists(args.output_json_directory):
-            os.makedirs(args.output_json_directory, exist_ok=True)
-            print(f"Created output JSON directory: {args.output_json_directory}")
-    elif args.command == "json2docx":
-        if not os.path.exists(args.output_docx_directory):
-            os.makedirs(args.output_docx_directory, exist_ok=True)
-            print(f"Created output DOCX directory: {args.output_docx_directory}")
-
+    # Each phase creates its own output directory.
     args.func(args) # Call the appropriate function based on the subcommand
 
 if __name__ == "__main__":
@@ -1,33 +1,40 @@
 # File: phase1_pdf_to_json.py
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
+from vertexai.generative_models import GenerativeModel, Part, GenerationConfig, FinishReason
+from google.api_core import exceptions as api_exceptions
+from google.cloud import storage
 import argparse # Keep for direct execution if needed, but wrapper will use its own
+import hashlib
 import os
+import random
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 
-# This function will be called by the wrapper
-def analyze_pdf_for_structured_output(pdf_path: str, model_name: str) -> str | None:
-    """
-    Sends a PDF to Gemini and requests structured output.
-    Returns the raw text response from Gemini.
-    Assumes vertexai.init() has been called.
-    """
-    print(f"Preparing to analyze {pdf_path} with model {model_name}...")
-    model = GenerativeModel(model_name)
+# Transient API errors (429, 500, 503, 504) that are worth retrying with backoff.
+_RETRYABLE_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+)
+_RETRY_BASE_DELAY = 2
+_RETRY_MAX_DELAY = 60
 
-    try:
-        with open(pdf_path, "rb") as f:
-            pdf_content_bytes = f.read()
-    except FileNotFoundError:
-        print(f"Error: PDF file not found at {pdf_path}")
-        return None
-    except Exception as e:
-        print(f"Error reading PDF file {pdf_path}: {e}")
-        return None
-    
-    pdf_part = Part.from_data(mime_type="application/pdf", data=pdf_content_bytes)
+# Finish reasons for which a streamed response is kept. MAX_TOKENS output is likely
+# truncated JSON, but it is still saved so it can be inspected or repaired by hand.
+_KEPT_FINISH_REASONS = (FinishReason.STOP, FinishReason.MAX_TOKENS)
+
+# PDFs smaller than this are sent inline even when a GCS staging bucket is configured,
+# since the upload round-trip would cost more than the inline bytes.
+_INLINE_PDF_MAX_BYTES = 1024 * 1024
 
-    prompt = """
+# Bump PROMPT_VERSION whenever PROMPT changes so cached responses for the old prompt are not reused.
+PROMPT_VERSION = "1"
+PROMPT = """
     You are an expert document structure analyzer. Please process the provided PDF document.
     Your task is to identify and extract content, discerning between different levels of headings,
     paragraphs, and tables.
@@ -60,42 +67,283 @@ def analyze_pdf_for_structured_output(pdf_path: str, model_name: str) -> str | N
     Represent tables accurately in Markdown. Ensure semantic paragraphs are distinct elements.
     The entire output must be a single, valid JSON object.
     """
-    
-    generation_config = GenerationConfig(
-        response_mime_type="application/json"
-    )
+_GENERATION_CONFIG = GenerationConfig(
+    response_mime_type="application/json"
+)
+
+
+class _RateLimiter:
+    """
+    Spaces out API calls made from worker threads so that consecutive calls
+    start at least `delay` seconds apart, regardless of how many threads run.
+    """
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._next_call = 0.0
+
+    def wait(self):
+        if self.delay <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_for = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.delay
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+def _server_retry_delay(error) -> float | None:
+    """
+    Returns the retry delay in seconds suggested by the server for a failed call,
+    from a gRPC RetryInfo detail or an HTTP Retry-After header, if either is present.
+    """
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers:
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def _sha256_file(path: str) -> str:
+    """Returns the hex SHA-256 digest of a file, read in chunks rather than all at once."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _default_cache_dir() -> str:
+    """
+    Returns the per-user response cache directory, shared by all runs so that re-running
+    Phase 1 on the same PDFs (into any output directory) is served from the cache.
+    """
+    base = os.environ.get("LOCALAPPDATA") if os.name == "nt" else os.environ.get("XDG_CACHE_HOME")
+    return os.path.join(base or os.path.join(os.path.expanduser("~"), ".cache"), "ai-pdf2docx")
+
+def _response_cache_path(cache_dir: str, pdf_sha256: str, model_name: str) -> str:
+    """Returns the cache file path for a (PDF content, model, prompt version) combination."""
+    key = hashlib.sha256((pdf_sha256 + model_name + PROMPT_VERSION).encode()).hexdigest()
+    return os.path.join(cache_dir, key + ".json")
+
+# Storage clients are not documented as thread-safe, so each worker thread keeps its own
+# and reuses its authorized HTTP session (and connection pool) across PDFs.
+_thread_local = threading.local()
+
+def _get_storage_client() -> storage.Client:
+    """Returns the calling thread's GCS client, creating it on first use."""
+    client = getattr(_thread_local, "storage_client", None)
+    if client is None:
+        client = _thread_local.storage_client = storage.Client()
+    return client
+
+def _stage_pdf_in_gcs(pdf_path: str, pdf_sha256: str, bucket_name: str) -> str:
+    """Uploads a PDF to the GCS staging bucket, unless already there, and returns its gs:// URI."""
+    blob_name = f"pdf2json/{pdf_sha256}.pdf"
+    blob = _get_storage_client().bucket(bucket_name).blob(blob_name)
+    if not blob.exists():
+        print(f"Uploading {pdf_path} to gs://{bucket_name}/{blob_name}...")
+        blob.upload_from_filename(pdf_path, content_type="application/pdf")
+    return f"gs://{bucket_name}/{blob_name}"
+
+def _copy_file_atomically(src_path: str, dst_path: str):
+    """Copies a file via a temporary file and os.replace, so readers never see a partial copy."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as dst, open(src_path, "rb") as src:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def _chunk_text(chunk) -> str:
+    """Returns the text of a streamed response chunk, or "" for chunks without text (e.g. the final one)."""
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        return ""
+
+@lru_cache(maxsize=4)
+def _get_model(model_name: str) -> GenerativeModel:
+    """Returns a shared GenerativeModel per model name; it is stateless and safe to reuse across threads."""
+    return GenerativeModel(model_name)
+
+def _has_pdf_header(pdf_path: str) -> bool:
+    """
+    Cheaply checks that a file is a PDF before paying for an API call on it.
+    Readers accept the %PDF marker anywhere in the first 1024 bytes, so this does too.
+    """
+    with open(pdf_path, "rb") as f:
+        return b"%PDF" in f.read(1024)
+
+def _prefetch_pdf(pdf_path: str):
+    """
+    Asks the kernel to start reading a PDF into the page cache in the background,
+    so a worker's later read overlaps with other workers' API calls. No-op where
+    posix_fadvise is unavailable (e.g. Windows, macOS).
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(pdf_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+# This function will be called by the wrapper
+def analyze_pdf_for_structured_output(pdf_path: str, output_json_path: str, model_name: str,
+                                      rate_limiter: _RateLimiter | None = None, max_retries: int = 5,
+                                      cache_dir: str | None = None, gcs_staging_bucket: str | None = None,
+                                      read_cache: bool = True) -> bool:
+    """
+    Sends a PDF to Gemini, requests structured output and streams the raw text
+    response to `output_json_path`. Returns True if the output file was written.
+    The response is written chunk by chunk to a temporary file, which only replaces
+    the output file once the response has finished normally.
+    Assumes vertexai.init() has been called.
+    If a rate limiter is given, it is waited on before each API call is made.
+    Transient API errors are retried up to `max_retries` times, waiting for the
+    server-suggested delay or an exponential backoff between attempts.
+    If `cache_dir` is given, responses are cached there by PDF content, model and
+    prompt version, and a cached response is used without calling the API unless
+    `read_cache` is False, in which case Gemini is queried and the cache refreshed.
+    If `gcs_staging_bucket` is given, PDFs of 1 MiB or more are uploaded there and
+    passed to Gemini by URI instead of being inlined in the request.
+    """
+    print(f"\nProcessing {pdf_path}...")
+    print(f"Preparing to analyze {pdf_path} with model {model_name}...")
+    model = _get_model(model_name)
+
+    try:
+        if not _has_pdf_header(pdf_path):
+            print(f"Skipping {pdf_path}, it does not look like a PDF file (no %PDF header).")
+            return False
+        pdf_size = os.path.getsize(pdf_path)
+        use_gcs = bool(gcs_staging_bucket) and pdf_size >= _INLINE_PDF_MAX_BYTES
+        # The digest keys the cache and the staged blob; skip the extra read when neither is used.
+        pdf_sha256 = _sha256_file(pdf_path) if cache_dir or use_gcs else None
+    except FileNotFoundError:
+        print(f"Error: PDF file not found at {pdf_path}")
+        return False
+    except Exception as e:
+        print(f"Error reading PDF file {pdf_path}: {e}")
+        return False
+
+    cache_path = None
+    if cache_dir:
+        cache_path = _response_cache_path(cache_dir, pdf_sha256, model_name)
+        if read_cache and os.path.exists(cache_path):
+            try:
+                _copy_file_atomically(cache_path, output_json_path)
+                print(f"Using cached Gemini response for {pdf_path}: {cache_path}")
+                return True
+            except Exception as e:
+                print(f"Warning: could not use response cache {cache_path}: {e}")
+
+    try:
+        if use_gcs:
+            pdf_uri = _stage_pdf_in_gcs(pdf_path, pdf_sha256, gcs_staging_bucket)
+            pdf_part = Part.from_uri(pdf_uri, mime_type="application/pdf")
+        else:
+            with open(pdf_path, "rb") as f:
+                pdf_part = Part.from_data(mime_type="application/pdf", data=f.read())
+    except Exception as e:
+        print(f"Error preparing PDF {pdf_path} for Gemini: {e}")
+        return False
 
     print(f"Sending {pdf_path} to Gemini model ({model_name})...")
+    tmp_path = None
     try:
-        response = model.generate_content(
-            [pdf_part, prompt],
-            generation_config=generation_config,
-        )
-        if response and response.text:
-            return response.text
-        elif response and response.candidates and response.candidates[0].finish_reason != "SAFETY":
-            print(f"Warning: Gemini returned an empty response for {pdf_path} but not due to safety. Check PDF content.")
-            return '{ "document_elements": [] }'
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_json_path) or ".", suffix=".tmp")
+        os.close(fd)
+        for attempt in range(max_retries + 1):
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            try:
+                # Reopening the file on each attempt discards any partial output from a failed one.
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    has_text = False
+                    last_candidate = None
+                    for chunk in model.generate_content(
+                        [pdf_part, PROMPT],
+                        generation_config=_GENERATION_CONFIG,
+                        stream=True,
+                    ):
+                        if chunk.candidates:
+                            last_candidate = chunk.candidates[0]
+                        text = _chunk_text(chunk)
+                        if text:
+                            f.write(text)
+                            has_text = True
+                break
+            except _RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                delay = _server_retry_delay(e)
+                if delay is None:
+                    delay = _RETRY_BASE_DELAY * 2 ** attempt + random.random()
+                delay = min(_RETRY_MAX_DELAY, delay)
+                print(f"Transient error from Gemini API for {pdf_path} ({e.__class__.__name__}). "
+                      f"Retrying in {delay:.1f} seconds (attempt {attempt + 1} of {max_retries})...")
+                time.sleep(delay)
+
+        finish_reason = last_candidate.finish_reason if last_candidate is not None else None
+        if finish_reason in _KEPT_FINISH_REASONS:
+            if not has_text:
+                print(f"Warning: Gemini returned an empty response for {pdf_path} but not due to safety. Check PDF content.")
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write('{ "document_elements": [] }')
+            elif finish_reason == FinishReason.MAX_TOKENS:
+                print(f"Warning: Gemini response for {pdf_path} hit the output token limit; the JSON is likely truncated.")
+            os.replace(tmp_path, output_json_path)
+            if cache_path and has_text and finish_reason == FinishReason.STOP:
+                try:
+                    _copy_file_atomically(output_json_path, cache_path)
+                except Exception as e:
+                    print(f"Warning: could not write response cache {cache_path}: {e}")
+            return True
         else:
             print(f"Error: Gemini response for {pdf_path} was empty or potentially blocked.")
-            if response and response.candidates:
-                 print(f"Finish reason: {response.candidates[0].finish_reason}")
-                 if response.candidates[0].safety_ratings:
-                    print(f"Safety ratings: {response.candidates[0].safety_ratings}")
-            return None
+            if last_candidate is not None:
+                 print(f"Finish reason: {finish_reason}")
+                 if last_candidate.safety_ratings:
+                    print(f"Safety ratings: {last_candidate.safety_ratings}")
+            return False
     except Exception as e:
         print(f"Error calling Gemini API for {pdf_path}: {e}")
         if hasattr(e, 'message'): print(f"Error details: {e.message}")
         if hasattr(e, '_response') and e._response and hasattr(e._response, 'text'):
              print(f"Gemini API Error Response (raw): {e._response.text}")
-        return None
+        return False
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def non_negative_int(value: str) -> int:
+    """argparse type for counts such as --max_retries, where a negative value makes no sense."""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or greater, got {value}")
+    return number
 
 def run_pdf_to_json_conversion(args):
     """
     Main logic for Phase 1: PDF to JSON conversion.
     Takes an argparse Namespace object.
     """
-    if not os.path.isdir(args.input_pdf_directory):
+    # Opening the directory doubles as the existence check.
+    try:
+        entries = os.scandir(args.input_pdf_directory)
+    except (FileNotFoundError, NotADirectoryError):
         print(f"Error: Input PDF directory '{args.input_pdf_directory}' not found.")
         return
     
@@ -106,34 +354,63 @@ def run_pdf_to_json_conversion(args):
         vertexai.init(project=args.project_id, location=args.location)
     except Exception as e:
         print(f"Failed to initialize Vertex AI: {e}")
+        entries.close()
         return
 
-    for filename in os.listdir(args.input_pdf_directory):
-        if filename.lower().endswith(".pdf"):
-            pdf_path = os.path.join(args.input_pdf_directory, filename)
-            json_filename = os.path.splitext(filename)[0] + ".json"
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or _default_cache_dir()
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Error: could not create cache directory '{cache_dir}': {e}")
+            entries.close()
+            return
+
+    # One directory listing up front makes the skip-existing check a set lookup per PDF.
+    existing_outputs = set() if args.overwrite else set(os.listdir(args.output_json_directory))
+    tasks = []
+    with entries:
+        for entry in entries:
+            # Only the suffix needs lowering, not the whole name.
+            if entry.name[-4:].lower() != ".pdf" or not entry.is_file():
+                continue
+            pdf_path = entry.path
+            json_filename = entry.name[:-4] + ".json"
             output_json_path = os.path.join(args.output_json_directory, json_filename)
             
-            if os.path.exists(output_json_path) and not args.overwrite:
+            if json_filename in existing_outputs:
                 print(f"Skipping {pdf_path}, JSON output already exists: {output_json_path}")
                 continue
 
-            print(f"\nProcessing {pdf_path}...")
-            raw_gemini_output = analyze_pdf_for_structured_output(pdf_path, args.model)
-            
-            if raw_gemini_output:
-                try:
-                    with open(output_json_path, "w", encoding="utf-8") as f:
-                        f.write(raw_gemini_output)
-                    print(f"Successfully saved Gemini's raw output to: {output_json_path}")
-                except Exception as e:
-                    print(f"Error saving JSON file {output_json_path}: {e}")
+            tasks.append((pdf_path, output_json_path))
+
+    # The Gemini calls are network-bound, so overlap them across worker threads.
+    # The rate limiter keeps the configured delay between calls across all workers.
+    rate_limiter = _RateLimiter(args.delay)
+    workers = args.workers or 8
+    # Keep the reads for the next batch of PDFs in flight while the current batch waits on the API.
+    prefetch_window = 2 * workers
+    for pdf_path, _ in tasks[:prefetch_window]:
+        _prefetch_pdf(pdf_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for pdf_path, output_json_path in tasks:
+            future = executor.submit(analyze_pdf_for_structured_output, pdf_path, output_json_path, args.model,
+                                     rate_limiter=rate_limiter, max_retries=args.max_retries,
+                                     cache_dir=cache_dir, gcs_staging_bucket=args.gcs_staging_bucket,
+                                     read_cache=not args.refresh_cache)
+            futures[future] = (pdf_path, output_json_path)
+
+        for completed, future in enumerate(as_completed(futures)):
+            if prefetch_window + completed < len(tasks):
+                _prefetch_pdf(tasks[prefetch_window + completed][0])
+            pdf_path, output_json_path = futures[future]
+            if future.result():
+                print(f"Successfully saved Gemini's raw output to: {output_json_path}")
             else:
                 print(f"Failed to get structured data for {pdf_path}. Skipping JSON file creation.")
-            
-            if args.delay > 0:
-                print(f"Waiting for {args.delay} seconds...")
-                time.sleep(args.delay)
 
     print("\nPhase 1 (PDF to JSON) processing complete.")
 
@@ -145,7 +422,13 @@ if __name__ == "__main__":
     parser.add_argument("--project_id", required=True, help="Google Cloud Project ID.")
     parser.add_argument("--location", default="global", help="Google Cloud location.")
     parser.add_argument("--model", default="gemini-2.5-pro-preview-05-06", help="Name of the Gemini model.")
-    parser.add_argument("--delay", type=int, default=0, help="Delay in seconds between API calls.")
+    parser.add_argument("--delay", type=int, default=0, help="Optional minimum delay in seconds between API calls.")
+    parser.add_argument("--max_retries", type=non_negative_int, default=5, help="Retries for rate-limited or transient API errors.")
+    parser.add_argument("--workers", type=int, default=8, help="Number of PDFs to send to Gemini concurrently.")
     parser.add_argument("--overwrite", action="store_true", help="Overwrite existing JSON files.")
+    parser.add_argument("--cache_dir", help="Directory for cached Gemini responses (default: per-user cache directory).")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read or write cached Gemini responses.")
+    parser.add_argument("--refresh_cache", action="store_true", help="Query Gemini even if a cached response exists, and update the cache.")
+    parser.add_argument("--gcs_staging_bucket", help="GCS bucket to stage PDFs of 1 MiB or more in, instead of inlining them.")
     args = parser.parse_args()
     run_pdf_to_json_conversion(args)
\ No newline at end of file
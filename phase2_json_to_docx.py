@@ -1,59 +1,238 @@
 # File: phase2_json_to_docx.py
 import json
 import argparse
+import copy
+import io
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from xml.sax.saxutils import escape
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 from docx import Document
+from docx.opc import phys_pkg
+from docx.shared import Emu
+
+# orjson parses large Gemini outputs several times faster and accepts bytes directly;
+# fall back to the standard library if it is not installed.
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Word paragraph style for each text element type in the Phase 1 JSON.
+STYLES = {
+    "heading_1": "Heading 1",
+    "heading_2": "Heading 2",
+    "heading_3": "Heading 3",
+    "paragraph": "Normal",
+}
+
+
+def _normalize_paragraph(content: str) -> str:
+    """
+    Joins a paragraph's visual line breaks into continuous prose. splitlines() also splits
+    on form feeds (common in PDF text) and other separators that python-docx would reject.
+    """
+    return ' '.join(content.splitlines()).strip()
+
+
+# Blank document parsed once per process; each output starts from a deep copy of it,
+# which is cheaper than having Document() re-read and re-parse the default template.
+_TEMPLATE_DOCUMENT = None
+
+
+def _new_document():
+    """Returns a fresh blank Document copied from the per-process template."""
+    global _TEMPLATE_DOCUMENT
+    if _TEMPLATE_DOCUMENT is None:
+        _TEMPLATE_DOCUMENT = Document()
+    return copy.deepcopy(_TEMPLATE_DOCUMENT)
+
+
+def _save_docx(doc, output_docx_path: str, fast_save: bool = False):
+    """
+    Saves a Document. With fast_save, the package is written with ZIP_STORED instead
+    of deflate, trading much larger files for less CPU per save.
+    """
+    if not fast_save:
+        doc.save(output_docx_path)
+        return
+    # python-docx has no compression option; its zip writer reads ZIP_DEFLATED from the
+    # phys_pkg module when opening the file, so swap it for the duration of the save.
+    # Phase 2 converts files in worker processes, one at a time, so this is not raced.
+    default_compression = phys_pkg.ZIP_DEFLATED
+    phys_pkg.ZIP_DEFLATED = ZIP_STORED
+    try:
+        doc.save(output_docx_path)
+    finally:
+        phys_pkg.ZIP_DEFLATED = default_compression
 
 
 def parse_markdown_table(markdown_table_content: str):
-    lines = [line.strip() for line in markdown_table_content.strip().split('\n') if line.strip()]
-    if not lines: return []
-    def clean_cell(cell_text): return cell_text.strip()
-    table_data = []; header_parsed = False; num_cols = 0
-    for i, line in enumerate(lines):
-        if not line.startswith('|') or not line.endswith('|'):
-            if i == 1 and all(c in '-|: ' for c in line): continue
-            continue
-        cells = [clean_cell(cell) for cell in line.strip('|').split('|')]
-        if not header_parsed:
-            table_data.append(cells); num_cols = len(cells); header_parsed = True
-        elif len(cells) == num_cols: table_data.append(cells)
-        elif len(cells) > num_cols and num_cols > 0:
-            table_data.append(cells[:num_cols])
-        elif len(cells) < num_cols and num_cols > 0:
-            cells.extend([''] * (num_cols - len(cells))); table_data.append(cells)
-        elif num_cols == 0 and cells:
-            table_data.append(cells); num_cols = len(cells)
+    """
+    Parses a GitHub-flavored Markdown table into a list of rows (lists of cell strings).
+    The separator row is dropped and every row is padded or truncated to the header's width.
+    """
+    table_data = []; num_cols = 0; after_header = False
+    for line in markdown_table_content.splitlines():
+        line = line.strip()
+        if len(line) < 2 or line[0] != '|' or line[-1] != '|': continue
+        # Only the row straight after the header can be the separator (e.g. |---|:--:|);
+        # later rows like | - | - | are data (missing values).
+        if after_header:
+            after_header = False
+            if '-' in line and not line.strip('|-: '): continue
+        cells = [cell.strip() for cell in line[1:-1].split('|')]
+        if not num_cols:
+            num_cols = len(cells); after_header = True
+        elif len(cells) != num_cols:
+            cells = (cells + [''] * num_cols)[:num_cols]
+        table_data.append(cells)
     return table_data
 
 
-def create_docx_from_structured_data(json_content_str: str, output_docx_path: str):
-    """Creates a DOCX file from the structured JSON data string using default Word styles."""
-    try:
-        data = json.loads(json_content_str)
-        if "document_elements" not in data or not isinstance(data["document_elements"], list):
-            print(f"Error: 'document_elements' key not found or not a list in JSON for {output_docx_path}.")
+# Characters that cannot appear in XML 1.0 text; dropped from content written directly as XML.
+_XML_INVALID_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+# Mirrors python-docx, which renders tabs and line breaks in run text as <w:tab/> and <w:br/>.
+_T_OPEN = '<w:t xml:space="preserve">'
+_TAB_XML = '</w:t><w:tab/>' + _T_OPEN
+_BR_XML = '</w:t><w:br/>' + _T_OPEN
+
+# Parts of the blank template needed to write a DOCX without python-docx, built once per process.
+_DIRECT_TEMPLATE = None
+
+
+def _direct_template():
+    """
+    Returns the cached pieces of the blank template: its package parts, the document.xml
+    text before and after the body content, the style IDs to use, and the text width in twips.
+    """
+    global _DIRECT_TEMPLATE
+    if _DIRECT_TEMPLATE is None:
+        template = _new_document()
+        buffer = io.BytesIO()
+        template.save(buffer)
+        with ZipFile(buffer) as zf:
+            parts = [(name, zf.read(name)) for name in zf.namelist()]
+        document_xml = dict(parts)["word/document.xml"].decode("utf-8")
+        body_end = document_xml.index("<w:sectPr")
+        style_ids = {el_type: template.styles[name].style_id for el_type, name in STYLES.items()}
+        style_ids["table_markdown"] = template.styles["Table Grid"].style_id
+        section = template.sections[-1]
+        block_width = Emu(section.page_width - section.left_margin - section.right_margin).twips
+        _DIRECT_TEMPLATE = (parts, document_xml[:body_end], document_xml[body_end:], style_ids, block_width)
+    return _DIRECT_TEMPLATE
+
+
+def _paragraph_xml(text: str, style_id: str | None = None, bold: bool = False) -> str:
+    """Returns the WordprocessingML for a single-run paragraph."""
+    text = escape(_XML_INVALID_CHARS.sub('', text))
+    text = text.replace('\t', _TAB_XML).replace('\r', _BR_XML).replace('\n', _BR_XML)
+    p_pr = f'<w:pPr><w:pStyle w:val="{style_id}"/></w:pPr>' if style_id else ''
+    r_pr = '<w:rPr><w:b/></w:rPr>' if bold else ''
+    return f'<w:p>{p_pr}<w:r>{r_pr}{_T_OPEN}{text}</w:t></w:r></w:p>'
+
+
+def _table_xml(table_data: list, style_id: str, block_width: int) -> str:
+    """Returns the WordprocessingML for a table laid out like python-docx's add_table, with a bold header row."""
+    num_cols = len(table_data[0])
+    col_width = block_width // num_cols
+    tc_open = f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{col_width}"/></w:tcPr>'
+    xml = [
+        f'<w:tbl><w:tblPr><w:tblStyle w:val="{style_id}"/><w:tblW w:type="auto" w:w="0"/>'
+        '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/>'
+        '</w:tblPr><w:tblGrid>',
+        f'<w:gridCol w:w="{col_width}"/>' * num_cols,
+        '</w:tblGrid>',
+    ]
+    for r, row_data in enumerate(table_data):
+        xml.append('<w:tr>')
+        for cell_text in row_data:
+            xml.append(tc_open)
+            # Like python-docx's cell.text, every cell gets one run, even when empty.
+            xml.append(_paragraph_xml(cell_text, bold=r == 0))
+            xml.append('</w:tc>')
+        xml.append('</w:tr>')
+    xml.append('</w:tbl>')
+    return ''.join(xml)
+
+
+def _is_directly_writable(elements: list) -> bool:
+    """True if every element is one of the known types with string content, so the XML fast path can render it."""
+    for element in elements:
+        if not isinstance(element, dict) or not isinstance(element.get("content", ""), str):
             return False
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON from file for {output_docx_path}: {e}")
+        el_type = element.get("type")
+        if el_type not in STYLES and el_type != "table_markdown":
+            return False
+    return True
+
+
+def _write_docx_xml(elements: list, output_docx_path: str, fast_save: bool = False):
+    """
+    Writes the DOCX by emitting word/document.xml directly and zipping it with the
+    template's other parts, bypassing python-docx's per-element object model.
+    Renders the known element types the same way the python-docx path does.
+    """
+    parts, document_head, document_tail, style_ids, block_width = _direct_template()
+
+    body = []
+    for element in elements:
+        el_type = element.get("type")
+        content = element.get("content", "")
+
+        if el_type == "table_markdown":
+            if content and content.strip():
+                table_data = parse_markdown_table(content)
+                if table_data:
+                    body.append(_table_xml(table_data, style_ids[el_type], block_width))
+            continue
+        if el_type == "paragraph":
+            content = _normalize_paragraph(content)
+        if content:
+            body.append(_paragraph_xml(content, style_ids[el_type]))
+
+    document_xml = (document_head + ''.join(body) + document_tail).encode("utf-8")
+    try:
+        with ZipFile(output_docx_path, "w", compression=ZIP_STORED if fast_save else ZIP_DEFLATED) as zf:
+            for name, blob in parts:
+                zf.writestr(name, document_xml if name == "word/document.xml" else blob)
+        print(f"Successfully created DOCX: {output_docx_path}")
+        return True
+    except Exception as e:
+        print(f"Error saving DOCX file {output_docx_path}: {e}")
         return False
 
-    doc = Document()
+
+def create_docx_from_structured_data(data: dict, output_docx_path: str, fast_save: bool = False):
+    """
+    Creates a DOCX file from the parsed structured JSON data using default Word styles.
+    With fast_save, the DOCX is written without zip compression.
+    Documents made only of the known element types are written directly as XML;
+    anything else goes through python-docx.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("document_elements"), list):
+        print(f"Error: 'document_elements' key not found or not a list in JSON for {output_docx_path}.")
+        return False
+
+    if _is_directly_writable(data["document_elements"]):
+        return _write_docx_xml(data["document_elements"], output_docx_path, fast_save)
+
+    doc = _new_document()
 
     for element in data.get("document_elements", []):
         el_type = element.get("type")
         content = element.get("content", "")
 
-        if el_type == "heading_1":
-            doc.add_paragraph(content, style='Heading 1') 
-        elif el_type == "heading_2":
-            doc.add_paragraph(content, style='Heading 2') 
-        elif el_type == "heading_3":
-            doc.add_paragraph(content, style='Heading 3') 
-        elif el_type == "paragraph":
-            processed_content = ' '.join(content.splitlines()).strip()
-            if processed_content:
-                doc.add_paragraph(processed_content, style='Normal') 
+        style = STYLES.get(el_type)
+        if style is not None:
+            if el_type == "paragraph":
+                content = _normalize_paragraph(content)
+            # Empty headings/paragraphs would only add blank styled paragraphs to the XML.
+            if content:
+                doc.add_paragraph(content, style=style)
         elif el_type == "table_markdown":
             if content and content.strip():
                 table_data = parse_markdown_table(content)
@@ -65,21 +244,20 @@ def create_docx_from_structured_data(json_content_str: str, output_docx_path: st
                     # doc.add_paragraph() # Optional: for explicit spacing before table
 
                     try:
-                        table_docx = doc.add_table(rows=0, cols=num_cols)
+                        # Create all rows up front rather than inserting them one add_row() at a time.
+                        table_docx = doc.add_table(rows=len(table_data), cols=num_cols)
                         table_docx.style = 'Table Grid' # 'Table Grid' is a common built-in table style
 
-                        hdr_cells = table_docx.add_row().cells
-                        for i, header_text in enumerate(table_data[0]):
-                            if i < num_cols:
-                                hdr_cells[i].text = header_text
-                                if hdr_cells[i].paragraphs and hdr_cells[i].paragraphs[0].runs:
-                                    hdr_cells[i].paragraphs[0].runs[0].font.bold = True
-                        
-                        for row_data in table_data[1:]:
-                            if len(row_data) == num_cols:
-                                row_cells = table_docx.add_row().cells
-                                for i, cell_text in enumerate(row_data):
-                                    row_cells[i].text = cell_text
+                        # parse_markdown_table pads/truncates every row to num_cols.
+                        table_rows = table_docx.rows
+                        for r, row_data in enumerate(table_data):
+                            row_cells = table_rows[r].cells
+                            for i, cell_text in enumerate(row_data):
+                                row_cells[i].text = cell_text
+
+                        for cell in table_rows[0].cells:
+                            # Setting .text leaves exactly one paragraph with exactly one run, even for empty text.
+                            cell.paragraphs[0].runs[0].font.bold = True
                         
                         # Optional: for explicit spacing after table
                         # doc.add_paragraph()
@@ -93,47 +271,80 @@ def create_docx_from_structured_data(json_content_str: str, output_docx_path: st
                  doc.add_paragraph(f"[Unknown type: {el_type}] {content}", style='Normal') # MODIFIED
 
     try:
-        doc.save(output_docx_path)
+        _save_docx(doc, output_docx_path, fast_save)
         print(f"Successfully created DOCX: {output_docx_path}")
         return True
     except Exception as e:
         print(f"Error saving DOCX file {output_docx_path}: {e}")
         return False
 
+def _convert_json_file(json_path: str, output_docx_path: str, fast_save: bool = False) -> bool:
+    """
+    Converts one JSON file to DOCX. Runs in a worker process, so it is defined at
+    module level and reports its own errors instead of raising them to the pool.
+    """
+    print(f"\nProcessing {json_path}...")
+    try:
+        with open(json_path, "rb") as f:
+            json_content = f.read()
+    except Exception as e:
+        print(f"Error reading JSON file {json_path}: {e}")
+        return False
+    
+    if not json_content.strip():
+        print(f"Skipping empty JSON file: {json_path}")
+        return False
+
+    try:
+        data = _json_loads(json_content)
+    except ValueError as e:
+        print(f"Error decoding JSON from file for {output_docx_path}: {e}")
+        return False
+
+    try:
+        return create_docx_from_structured_data(data, output_docx_path, fast_save)
+    except Exception as e:
+        print(f"Error converting {json_path} to DOCX: {e}")
+        return False
+
 def run_json_to_docx_conversion(args):
     """
     Main logic for Phase 2: JSON to DOCX conversion.
     Takes an argparse Namespace object.
     """
-    if not os.path.isdir(args.input_json_directory):
+    # Opening the directory doubles as the existence check.
+    try:
+        entries = os.scandir(args.input_json_directory)
+    except (FileNotFoundError, NotADirectoryError):
         print(f"Error: Input JSON directory '{args.input_json_directory}' not found.")
         return
     
     os.makedirs(args.output_docx_directory, exist_ok=True)
 
-    for filename in os.listdir(args.input_json_directory):
-        if filename.lower().endswith(".json"):
-            json_path = os.path.join(args.input_json_directory, filename)
-            docx_filename = os.path.splitext(filename)[0] + ".docx"
+    # One directory listing up front makes the skip-existing check a set lookup per JSON file.
+    existing_outputs = set() if args.overwrite else set(os.listdir(args.output_docx_directory))
+    json_paths = []
+    docx_paths = []
+    with entries:
+        for entry in entries:
+            if not entry.name.lower().endswith(".json") or not entry.is_file():
+                continue
+            json_path = entry.path
+            docx_filename = os.path.splitext(entry.name)[0] + ".docx"
             output_docx_path = os.path.join(args.output_docx_directory, docx_filename)
 
-            if os.path.exists(output_docx_path) and not args.overwrite:
+            if docx_filename in existing_outputs:
                 print(f"Skipping {json_path}, DOCX output already exists: {output_docx_path}")
                 continue
             
-            print(f"\nProcessing {json_path}...")
-            try:
-                with open(json_path, "r", encoding="utf-8") as f:
-                    json_content_str = f.read()
-            except Exception as e:
-                print(f"Error reading JSON file {json_path}: {e}")
-                continue
-            
-            if json_content_str.strip():
-                create_docx_from_structured_data(json_content_str, output_docx_path)
-            else:
-                print(f"Skipping empty JSON file: {json_path}")
-                
+            json_paths.append(json_path)
+            docx_paths.append(output_docx_path)
+
+    # DOCX generation is CPU-bound pure Python, so fan files out across processes.
+    # None lets the executor pick its default, which is capped on Windows (max 61 workers).
+    with ProcessPoolExecutor(max_workers=args.workers or None) as executor:
+        list(executor.map(partial(_convert_json_file, fast_save=args.fast_save), json_paths, docx_paths, chunksize=4))
+
     print("\nPhase 2 (JSON to DOCX) processing complete.")
 
 if __name__ == "__main__":
@@ -141,5 +352,7 @@ if __name__ == "__main__":
     parser.add_argument("input_json_directory", help="Path to the directory containing JSON files.")
     parser.add_argument("output_docx_directory", help="Path to the directory where DOCX files will be saved.")
     parser.add_argument("--overwrite", action="store_true", help="Overwrite existing DOCX files.")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs).")
+    parser.add_argument("--fast_save", action="store_true", help="Write DOCX files without zip compression (faster, larger files).")
     args = parser.parse_args()
     run_json_to_docx_conversion(args)
\ No newline at end of file